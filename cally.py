@@ -33,10 +33,17 @@
 # Imports
 #
 import argparse
-import fileinput
+import codecs
+import collections
+import io
+import json
+import multiprocessing
 import os
+import random
 import re
+import shutil
 import sys
+import tempfile
 import time
 
 
@@ -336,6 +343,772 @@ def unit_test_add_call(functions, function_name, calls):
     functions[function_name]["callee_refs"] = dict()
 
 
+#
+# Randomized differential tests. Random RTL corpora are generated, and the
+# output of the parser, dump_path(), dump_paths(), full_call_graph(), the
+# json output formats, the cache and the CallGraph queries is compared with
+# the reference implementation below. This is a copy of the original parser,
+# dump_path() and full_call_graph() code, and should only be changed when the
+# intended output changes. In addition, the run time is measured for
+# increasing corpus sizes to catch super-linear behavior.
+#
+# Invoke as: cally.py --random-test SEED dummy
+#
+random_test_iterations = 40
+random_test_chain_iterations = 2
+random_test_chain_size = 600
+random_test_chain_depth = 500
+random_test_time_sizes = [500, 1000, 2000, 4000]
+random_test_time_roots = 20
+random_test_time_depth = 50
+random_test_time_ratio = 2.0
+
+
+#
+# reference_parse()
+#
+def reference_parse(rtl_files):
+    functions = dict()
+    function = re.compile(
+        r"^;; Function (?P<mangle>.*)\s+\((?P<function>\S+)(,.*)?\).*$")
+    call = re.compile(
+        r"^.*\(call.*\"(?P<target>.*)\".*$")
+    symbol_ref = re.compile(r"^.*\(symbol_ref.*\"(?P<target>.*)\".*$")
+
+    function_name = ""
+    for filename, lines in rtl_files:
+        for line in lines:
+            match = re.match(function, line)
+            if match is not None:
+                function_name = match.group("function")
+                if function_name not in functions:
+                    functions[function_name] = dict()
+                    functions[function_name]["files"] = list()
+                    functions[function_name]["calls"] = dict()
+                    functions[function_name]["refs"] = dict()
+                    functions[function_name]["callee_calls"] = dict()
+                    functions[function_name]["callee_refs"] = dict()
+
+                functions[function_name]["files"].append(filename)
+            else:
+                match = re.match(call, line)
+                if match is not None:
+                    target = match.group("target")
+                    if target not in functions[function_name]["calls"]:
+                        functions[function_name]["calls"][target] = True
+                else:
+                    match = re.match(symbol_ref, line)
+                    if match is not None:
+                        target = match.group("target")
+                        if target not in functions[function_name]["refs"]:
+                            functions[function_name]["refs"][target] = True
+
+    for call, value in functions.items():
+        for callee in value["calls"]:
+            if callee in functions and \
+               call not in functions[callee]["callee_calls"]:
+                functions[callee]["callee_calls"][call] = 1
+
+        for callee in value["refs"]:
+            if callee in functions and \
+               call not in functions[callee]["callee_refs"]:
+                functions[callee]["callee_refs"][call] = 1
+
+    return functions
+
+
+#
+# reference_dump_path_ascii()
+#
+def reference_dump_path_ascii(buf, path, reverse, **kwargs):
+    externs = kwargs.get("externs", False)
+    truncated = kwargs.get("truncated", False)
+
+    if len(path) == 0:
+        return
+
+    ascii_path = ""
+    for function in reversed(path) if reverse else path:
+        if ascii_path != "":
+            ascii_path += " -> "
+        ascii_path += '"' + function + '"'
+
+    if truncated or externs:
+        ascii_path += ';\n"{}"{}{}'. \
+                      format(function if not reverse else path[-1],
+                             " [style=dashed]" if externs else "",
+                             " [color=red]" if truncated else "")
+
+    buf.append(ascii_path + ";")
+
+
+#
+# reference_dump_path()
+#
+def reference_dump_path(buf, path, functions, function_name, **kwargs):
+    max_depth = kwargs.get("max_depth", 0)
+    reverse_path = kwargs.get("reverse_path", False)
+    exclude = kwargs.get("exclude", None)
+    call_index = kwargs.get("call_index", "calls")
+    no_externs = kwargs.get("no_externs", False)
+
+    if "__seen_in_path" in kwargs:
+        seen_in_path = kwargs["__seen_in_path"]
+    else:
+        seen_in_path = dict()
+        kwargs["__seen_in_path"] = seen_in_path
+
+    if (exclude is not None and re.match(exclude, function_name) is not None) \
+       or (max_depth > 0 and len(path) >= max_depth):
+        reference_dump_path_ascii(buf, path, reverse_path, truncated=True)
+        return
+
+    if function_name in seen_in_path:
+        if (max_depth <= 0 or (len(path) + 1) <= max_depth):
+            reference_dump_path_ascii(buf, path + [function_name],
+                                      reverse_path)
+        return
+
+    seen_in_path[function_name] = True
+
+    children = 0
+    for caller in functions[function_name][call_index]:
+        if caller in functions:
+            children += 1
+            if function_name != caller:
+                reference_dump_path(buf, path + [function_name],
+                                    functions, caller, **kwargs)
+            else:
+                reference_dump_path_ascii(buf, path + [function_name, caller],
+                                          reverse_path)
+        elif (exclude is None or re.match(exclude, caller) is None) and \
+             (max_depth <= 0 or (len(path) + 2) <= max_depth) and \
+                not no_externs:
+            children += 1
+            reference_dump_path_ascii(buf, path + [function_name, caller],
+                                      reverse_path, externs=True)
+        else:
+            buf.append('"{}" [color=red];'.format(function_name))
+
+    if children == 0:
+        reference_dump_path_ascii(buf, path + [function_name], reverse_path)
+
+
+#
+# reference_full_call_graph()
+#
+def reference_full_call_graph(buf, functions, **kwargs):
+    exclude = kwargs.get("exclude", None)
+    no_externs = kwargs.get("no_externs", False)
+
+    buf.append("strict digraph callgraph {")
+    for func in sorted(functions.keys()):
+        printed_functions = 0
+        if exclude is None or \
+           re.match(exclude, func) is None:
+
+            for caller in sorted(functions[func]["calls"].keys()):
+                if (not no_externs or caller in functions) and \
+                   (exclude is None or
+                   re.match(exclude, caller) is None):
+
+                    buf.append('"{}" -> "{}";'.format(func, caller))
+
+                    if caller not in functions:
+                        buf.append('"{}" [style=dashed]'.format(caller))
+
+                    printed_functions += 1
+
+            if printed_functions == 0:
+                buf.append('"{}"'.format(func))
+
+    buf.append("}")
+
+
+#
+# random_test_corpus()
+#
+# Generate RTL files for size functions, with deep call chains, cycles,
+# self-recursion, calls to external functions, symbol references, functions
+# defined in multiple files, lines the parser should ignore and calls before
+# the first function of a file. The first chain functions always call the
+# next one first, and are defined once, so the walk from fn_0 is at least
+# that deep.
+#
+def random_test_corpus(rnd, size, chain=0):
+    names = ["fn_{}".format(i) for i in range(size)]
+    externs = ["ext_{}".format(i) for i in range(max(1, size // 10))]
+    rtl_files = [("random_{}.c.229r.expand".format(i), list())
+                 for i in range(rnd.randint(1, 4))]
+
+    for filename, lines in rtl_files:
+        if rnd.random() < 0.3:
+            lines.append('(call_insn 7 6 8 2 (call (mem:QI (symbol_ref:DI '
+                         '("stray") [flags 0x41] <function_decl 0x7f stray>) '
+                         '[0 stray S1 A8])\n')
+
+    redefined = names[chain:]
+    redefined = rnd.sample(redefined, min(len(redefined), size // 20))
+    for i, name in enumerate(names + redefined):
+        lines = rnd.choice(rtl_files)[1]
+        lines.append("\n")
+        lines.append(";; Function {0} ({0}, funcdef_no={1}, decl_uid={1}, "
+                     "cgraph_uid={1}, symbol_order={1})\n".format(name, i))
+        lines.append("\n")
+
+        targets = list()
+        if i + 1 < size and (i + 1 < chain or rnd.random() < 0.6):
+            targets.append(names[i + 1])
+        if rnd.random() < 0.1:
+            targets.append(name)
+        if rnd.random() < 0.2:
+            targets.append(names[rnd.randint(0, min(i, size - 1))])
+        targets += rnd.sample(names, rnd.randint(0, min(2, size)))
+        targets += rnd.sample(externs, rnd.randint(0, 1))
+        rnd.shuffle(targets)
+        if i + 1 < chain:
+            targets.insert(0, names[i + 1])
+
+        for target in targets:
+            if rnd.random() < 0.3:
+                lines.append("(insn 2 1 3 2 (set (reg:SI 0 ax) "
+                             "(const_int 0 [0])) -1\n")
+            if rnd.random() < 0.3:
+                lines.append('(insn 5 4 6 2 (set (reg:DI 5 di) '
+                             '(symbol_ref:DI ("{}") [flags 0x3])) -1\n'.
+                             format(rnd.choice(names + externs)))
+            lines.append('(call_insn 7 6 8 2 (call (mem:QI (symbol_ref:DI '
+                         '("{0}") [flags 0x41] <function_decl 0x7f {0}>) '
+                         '[0 {0} S1 A8])\n'.format(target))
+
+    return rtl_files
+
+
+#
+# random_test_strip()
+#
+# Remove the lines before the first function of each file. The parser
+# ignores them, while the reference parser adds them to the last function of
+# the previous file.
+#
+def random_test_strip(rtl_files):
+    stripped = list()
+    for filename, lines in rtl_files:
+        for i, line in enumerate(lines):
+            if line.startswith(";; Function "):
+                break
+        else:
+            i = len(lines)
+        stripped.append((filename, lines[i:]))
+    return stripped
+
+
+#
+# random_test_file_boundaries()
+#
+# Check the calls before the first function of a file are not added to the
+# last function of the previous file. Returns the number of failures.
+#
+def random_test_file_boundaries():
+    rtl_files = [
+        ("first.c.229r.expand",
+         [";; Function first (first, funcdef_no=0)\n",
+          '(call_insn 7 6 8 2 (call (mem:QI (symbol_ref:DI ("a"))))\n']),
+        ("second.c.229r.expand",
+         ['(call_insn 7 6 8 2 (call (mem:QI (symbol_ref:DI ("b"))))\n',
+          ";; Function second (second, funcdef_no=0)\n",
+          '(call_insn 7 6 8 2 (call (mem:QI (symbol_ref:DI ("c"))))\n'])]
+
+    graph = random_test_graph(rtl_files)
+    graph.build_callee_info()
+    results = [json.dumps(graph.functions)]
+
+    failures = unit_test_check_error(
+        "PARSER, FILE BOUNDARIES",
+        [json.dumps(reference_parse(random_test_strip(rtl_files)))],
+        results)
+
+    if results == [json.dumps(reference_parse(rtl_files))]:
+        print_err("[FAIL] PARSER, FILE BOUNDARIES, same as reference")
+        failures += 1
+
+    return failures
+
+
+#
+# random_test_graph()
+#
+def random_test_graph(rtl_files, **kwargs):
+    graph = CallGraph()
+    for filename, lines in rtl_files:
+        graph.add_rtl_lines(lines, filename, no_warnings=True, **kwargs)
+    return graph
+
+
+#
+# random_test_capture()
+#
+# Run function, and return everything written to stdout as a list of lines.
+# The output is captured through the same buffered text layers as the real
+# stdout, so writes use the same call depth.
+#
+def random_test_capture(function, *args, **kwargs):
+    stdout = sys.stdout
+    capture = io.BytesIO()
+    sys.stdout = io.TextIOWrapper(capture, encoding="utf-8",
+                                  errors="surrogateescape")
+    try:
+        function(*args, **kwargs)
+        sys.stdout.flush()
+        return capture.getvalue().decode(
+            "utf-8", "surrogateescape").splitlines()
+    finally:
+        sys.stdout.detach()
+        sys.stdout = stdout
+
+
+#
+# random_test_json()
+#
+# Convert the json and ndjson output to the matching .dot output, so it can
+# be compared with the reference output. Returns None if the two formats do
+# not hold the same records.
+#
+def random_test_json(json_lines, ndjson_lines, reverse):
+    records = json.loads("\n".join(json_lines))
+    if records != [json.loads(line) for line in ndjson_lines]:
+        return None
+
+    dot = list()
+    for record in records:
+        if record["type"] == "graph":
+            dot.append("strict digraph callgraph {")
+        elif record["type"] == "root":
+            dot.append('"{}" [color=blue, style=filled];'.
+                       format(record["name"]))
+        elif record["type"] == "edge":
+            dot.append('"{}" -> "{}";'.
+                       format(record["caller"], record["callee"]))
+            if record["external"]:
+                dot.append('"{}" [style=dashed]'.format(record["callee"]))
+        elif record["type"] == "node":
+            dot.append('"{}"{}{}'.format(
+                record["name"],
+                " [style=dashed]" if record["external"] else "",
+                " [color=red];" if record["truncated"] else ""))
+        elif record["type"] == "path":
+            nodes = record["nodes"]
+            dot.append(" -> ".join('"' + node + '"' for node in nodes) + ";")
+            if record["external"] or record["truncated"]:
+                dot.append('"{}"{}{};'.format(
+                    nodes[0] if reverse else nodes[-1],
+                    " [style=dashed]" if record["external"] else "",
+                    " [color=red]" if record["truncated"] else ""))
+
+    dot.append("}")
+    return dot
+
+
+#
+# random_test_iteration()
+#
+# Run all differential tests for a single random corpus, and return the
+# number of tests run and the number of failures. For a chain corpus, the
+# start of the chain is always one of the roots.
+#
+def random_test_iteration(rnd, size, chain=0):
+    total = 0
+    failures = 0
+
+    rtl_files = random_test_corpus(rnd, size, chain)
+    ref_functions = reference_parse(random_test_strip(rtl_files))
+
+    #
+    # Parser and cache
+    #
+    total += 1
+    graph = random_test_graph(rtl_files)
+    graph.build_callee_info()
+    failures += unit_test_check_error("PARSER",
+                                      [json.dumps(ref_functions)],
+                                      [json.dumps(graph.functions)])
+
+    total += 1
+    pruned_graph = random_test_graph(rtl_files, symbol_refs=False)
+    list(pruned_graph.callers(rnd.choice(sorted(ref_functions.keys()))))
+    pruned_ref = json.loads(json.dumps(ref_functions))
+    for finfo in pruned_ref.values():
+        finfo["refs"] = dict()
+        finfo["callee_refs"] = dict()
+    failures += unit_test_check_error("PARSER, NO SYMBOL REFS",
+                                      [json.dumps(pruned_ref)],
+                                      [json.dumps(pruned_graph.functions)])
+
+    total += 1
+    cache_fd, cache_file = tempfile.mkstemp(suffix=".json")
+    os.close(cache_fd)
+    try:
+        graph.save_cache(cache_file)
+        cache_graph = CallGraph.from_cache(cache_file)
+    finally:
+        os.remove(cache_file)
+    cache_graph.build_callee_info()
+    failures += unit_test_check_error("CACHE",
+                                      [json.dumps(ref_functions)],
+                                      [json.dumps(cache_graph.functions)])
+
+    functions = graph.functions
+    #
+    # For a chain corpus, only use options that keep the chain intact
+    #
+    if chain > 0:
+        exclude = rnd.choice([None, "ext_.*"])
+    else:
+        exclude = rnd.choice([None, None, "fn_1.*", "ext_.*|fn_2",
+                              "fn_.*3$"])
+    no_externs = rnd.random() < 0.3
+
+    #
+    # Full call graph, and the edges() query
+    #
+    total += 1
+    ref = list()
+    reference_full_call_graph(ref, ref_functions, exclude=exclude,
+                              no_externs=no_externs)
+    ref = "\n".join(ref).splitlines()
+    failures += unit_test_check_error(
+        "FULL GRAPH", ref,
+        random_test_capture(full_call_graph, functions, exclude=exclude,
+                            no_externs=no_externs))
+
+    total += 1
+    json_dot = random_test_json(
+        random_test_capture(full_call_graph, functions, exclude=exclude,
+                            no_externs=no_externs, output_format="json"),
+        random_test_capture(full_call_graph, functions, exclude=exclude,
+                            no_externs=no_externs, output_format="ndjson"),
+        False)
+    failures += unit_test_check_error("FULL GRAPH, JSON", ref,
+                                      json_dot or [])
+
+    total += 1
+    ref = list()
+    reference_full_call_graph(ref, ref_functions)
+    failures += unit_test_check_error(
+        "EDGES", [line for line in ref if " -> " in line],
+        ['"{}" -> "{}";'.format(caller, callee)
+         for caller, callee in graph.edges()])
+
+    #
+    # Caller and callee paths for random roots and options
+    #
+    roots = rnd.sample(sorted(functions.keys()),
+                       min(len(functions), rnd.randint(1, 5)))
+    if chain > 0 and "fn_0" not in roots:
+        roots[0] = "fn_0"
+    for reverse in [False, True]:
+        kwargs = {"max_depth": rnd.choice([0, chain + 1] if chain > 0 else
+                                          [0, 0, 1, 2, 3, 5, 8]),
+                  "exclude": exclude}
+        if reverse:
+            kwargs["reverse_path"] = True
+            kwargs["call_index"] = "callee_calls"
+        else:
+            kwargs["no_externs"] = no_externs
+        test = "{}, {}".format("CALLEE" if reverse else "CALLER", kwargs)
+
+        full_ref = ["strict digraph callgraph {"]
+        for root in roots:
+            ref = list()
+            reference_dump_path(ref, [], ref_functions, root, **kwargs)
+            ref = "\n".join(ref).splitlines()
+            full_ref.append('"{}" [color=blue, style=filled];'.format(root))
+            full_ref += ref
+
+            total += 1
+            failures += unit_test_check_error(
+                "DUMP PATH, " + test, ref,
+                random_test_capture(dump_path, [], functions, root,
+                                    **kwargs))
+
+            total += 1
+            ndjson_lines = random_test_capture(dump_path, [], functions,
+                                               root, output_format="ndjson",
+                                               **kwargs)
+            lazy_graph = random_test_graph(rtl_files, symbol_refs=False)
+            paths = list(lazy_graph.paths(root, reverse=reverse,
+                                          max_depth=kwargs["max_depth"],
+                                          exclude=exclude,
+                                          no_externs=no_externs and
+                                          not reverse))
+            failures += unit_test_check_error(
+                "PATHS, " + test,
+                [json.dumps(json.loads(line)) for line in ndjson_lines],
+                [json.dumps(record) for record in paths])
+
+            #
+            # Without any limits, the paths hold exactly all reachable
+            # functions.
+            #
+            if kwargs["max_depth"] == 0 and exclude is None and \
+               not no_externs:
+                total += 1
+                nodes = set([root])
+                for record in paths:
+                    nodes.update(record["nodes"])
+                lazy_graph = random_test_graph(rtl_files, symbol_refs=False)
+                reachable = set(lazy_graph.reachable(root, reverse=reverse))
+                reachable.add(root)
+                failures += unit_test_check_error(
+                    "REACHABLE, " + test, sorted(nodes), sorted(reachable))
+
+        full_ref.append("}")
+
+        for jobs in [1, rnd.randint(2, 4)]:
+            total += 1
+            output_format = rnd.choice(["dot", "json", "ndjson"])
+            results = list()
+            for format_ in ["json", "ndjson"] \
+                    if output_format != "dot" else ["dot"]:
+                results.append(random_test_capture(
+                    random_test_dump_paths,
+                    random_test_graph(rtl_files, symbol_refs=False), roots,
+                    jobs=jobs, output_format=format_, **kwargs))
+            if output_format != "dot":
+                results = random_test_json(results[0], results[1], reverse)
+            else:
+                results = results[0]
+            failures += unit_test_check_error(
+                "DUMP PATHS, {}, JOBS {}, {}".format(output_format.upper(),
+                                                     jobs, test),
+                full_ref, results or [])
+
+    return total, failures
+
+
+#
+# random_test_dump_paths()
+#
+def random_test_dump_paths(graph, roots, **kwargs):
+    output_format = kwargs.get("output_format", "dot")
+    print_graph_begin(None, output_format, "random")
+    graph.dump_paths(roots, **kwargs)
+    print_graph_end(None, output_format)
+
+
+#
+# random_test_deep_chain()
+#
+# Find the longest call chain a serial dump_paths() can walk before running
+# into the recursion limit, and check the parallel workers give the same
+# output for it. Returns the number of failures.
+#
+def random_test_deep_chain():
+    def chain_functions(length):
+        functions = dict()
+        for i in range(length):
+            unit_test_add_call(functions, "fn_{}".format(i),
+                               ["fn_{}".format(i + 1)]
+                               if i + 1 < length else [])
+        return functions
+
+    low = 2
+    high = sys.getrecursionlimit()
+    while low < high:
+        length = (low + high + 1) // 2
+        try:
+            random_test_capture(dump_paths, chain_functions(length),
+                                ["fn_0", "fn_1"], jobs=1)
+            low = length
+        except RecursionError:
+            high = length - 1
+
+    print_dbg("Chain of {} functions".format(low))
+    functions = chain_functions(low)
+    ref = random_test_capture(dump_paths, functions, ["fn_0", "fn_1"],
+                              jobs=1)
+    try:
+        results = random_test_capture(dump_paths, functions,
+                                      ["fn_0", "fn_1"], jobs=2)
+    except RecursionError:
+        results = list()
+    return unit_test_check_error("DEEP CHAIN, JOBS 2", ref, results)
+
+
+#
+# random_test_parallel_order()
+#
+# Check a slow first root does not hold up the other workers, i.e. later
+# roots finish before it, and the output is still in the order of the roots.
+# Also check the stdio_buffer option is refused with multiple jobs. Returns
+# the number of failures.
+#
+def random_test_parallel_order():
+    failures = 0
+    functions = dict()
+    externs = ["ext_{}".format(i) for i in range(20)]
+    for i in range(300):
+        unit_test_add_call(functions, "slow_{}".format(i),
+                           ["slow_{}".format(i + 1)] + externs
+                           if i + 1 < 300 else externs)
+    roots = ["slow_0"]
+    for i in range(20):
+        unit_test_add_call(functions, "fast_{}".format(i), [])
+        roots.append("fast_{}".format(i))
+
+    order = [result[0] for result in
+             parallel_dump_path_results(functions, roots, 2,
+                                        recursion_headroom())]
+    print_dbg("Completion order {}".format(order))
+    if sorted(order) != list(range(len(roots))) or order[0] == 0:
+        print_err("[FAIL] PARALLEL ORDER, first root finished first")
+        failures += 1
+
+    failures += unit_test_check_error(
+        "PARALLEL ORDER, JOBS 2",
+        random_test_capture(dump_paths, functions, roots, jobs=1),
+        random_test_capture(dump_paths, functions, roots, jobs=2))
+
+    try:
+        dump_paths(functions, roots, jobs=2, stdio_buffer=list())
+        print_err("[FAIL] PARALLEL STDIO BUFFER, not refused")
+        failures += 1
+    except ValueError:
+        pass
+
+    return failures
+
+
+#
+# random_test_time()
+#
+# Return the best of three run times of function.
+#
+def random_test_time(function, *args, **kwargs):
+    best = None
+    for _ in range(3):
+        start_time = time.time()
+        function(*args, **kwargs)
+        run_time = time.time() - start_time
+        if best is None or run_time < best:
+            best = run_time
+    return best
+
+
+#
+# random_test_time_growth()
+#
+# Measure the parser, callee info, full graph and path walk times for
+# increasing corpus sizes, normalized to the time per input line, function
+# or output character. For linear behavior this should stay the same, so
+# report each doubling of the size for which it grows more than
+# random_test_time_ratio times.
+#
+def random_test_time_growth(rnd):
+    slow = 0
+    previous = None
+    for size in random_test_time_sizes:
+        rtl_files = random_test_corpus(rnd, size)
+        lines = sum(len(lines) for _, lines in rtl_files)
+        graph = random_test_graph(rtl_files)
+        roots = ["fn_{}".format(i) for i in range(random_test_time_roots)]
+        paths = random_test_capture(dump_paths, graph.functions, roots,
+                                    max_depth=random_test_time_depth)
+
+        times = dict()
+        times["parser"] = random_test_time(
+            lambda: [CallGraph().add_rtl_lines(lines, filename,
+                                               no_warnings=True)
+                     for filename, lines in rtl_files]) / lines
+        times["callee info"] = random_test_time(
+            build_callee_info, graph.functions) / size
+        times["full graph"] = random_test_time(
+            random_test_capture, full_call_graph, graph.functions) / size
+        times["dump path"] = random_test_time(
+            random_test_capture, dump_paths, graph.functions, roots,
+            max_depth=random_test_time_depth) / \
+            max(1, sum(len(line) for line in paths))
+
+        print_dbg("Size {}: {}".format(
+            size, ", ".join("{} {:.3f}us".format(name, times[name] * 1e6)
+                            for name in sorted(times))))
+
+        if previous is not None:
+            for name in sorted(times):
+                if times[name] > previous[name] * random_test_time_ratio:
+                    print_err("[SLOW] \"{}\" from {} to {} functions, "
+                              "{:.3f}us vs {:.3f}us per item".
+                              format(name, size // 2, size,
+                                     previous[name] * 1e6,
+                                     times[name] * 1e6))
+                    slow += 1
+        previous = times
+
+    return slow
+
+
+#
+# Actual random test
+#
+def random_test(seed):
+    rnd = random.Random(seed)
+
+    print_dbg("RANDOM TEST START, SEED {}".format(seed))
+    print_dbg("--------------------------")
+
+    total = 0
+    failures = 0
+    for i in range(random_test_iterations):
+        size = rnd.choice([1, 2, 5, 10, 25, 50, 100, 150])
+        print_dbg("Iteration {}, {} functions".format(i, size))
+        run, failed = random_test_iteration(rnd, size)
+        total += run
+        failures += failed
+
+    for i in range(random_test_chain_iterations):
+        print_dbg("Chain iteration {}, {} functions, {} deep".
+                  format(i, random_test_chain_size, random_test_chain_depth))
+        run, failed = random_test_iteration(rnd, random_test_chain_size,
+                                            random_test_chain_depth)
+        total += run
+        failures += failed
+
+    print_dbg("")
+    print_dbg("PARSER FILE BOUNDARIES")
+    print_dbg("======================")
+    total += 1
+    failures += random_test_file_boundaries()
+
+    print_dbg("")
+    print_dbg("DEEP CHAIN")
+    print_dbg("==========")
+    total += 1
+    failures += random_test_deep_chain()
+
+    print_dbg("")
+    print_dbg("PARALLEL ORDER")
+    print_dbg("==============")
+    total += 1
+    failures += random_test_parallel_order()
+
+    print_dbg("")
+    print_dbg("TIME GROWTH")
+    print_dbg("===========")
+    slow = random_test_time_growth(rnd)
+
+    print_dbg("")
+    print_dbg("RANDOM TEST END, RESULTS")
+    print_dbg("------------------------")
+    print_dbg("Total tests run: {}".format(total))
+    print_dbg("Total errors   : {}".format(failures))
+    print_dbg("Total slow     : {}".format(slow))
+    if failures > 0:
+        print_err("!!! ERRORS WHERE FOUND !!!")
+        return 1
+
+    return 0
+
+
 #
 # Add callee to database
 #
@@ -352,17 +1125,48 @@ def build_callee_info(function_db):
                 function_db[callee]["callee_refs"][call] = 1
 
 
+#
+# path_record()
+#
+# Path record as used by the json output formats and CallGraph.paths(). The
+# flags apply to the last function reached by the traversal, i.e. the first
+# node in the list for a callee graph.
+#
+def path_record(path, reverse, **kwargs):
+    return {"type": "path",
+            "nodes": list(reversed(path)) if reverse else list(path),
+            "external": kwargs.get("externs", False),
+            "truncated": kwargs.get("truncated", False),
+            "recursive": path[-1] in path[:-1]}
+
+
+#
+# node_record()
+#
+def node_record(function, **kwargs):
+    return {"type": "node", "name": function,
+            "external": kwargs.get("externs", False),
+            "truncated": kwargs.get("truncated", False)}
+
+
 #
 # dump_path_ascii()
 #
 def dump_path_ascii(path, reverse, **kwargs):
     externs = kwargs.get("externs", False)
     truncated = kwargs.get("truncated", False)
+    output_format = kwargs.get("output_format", "dot")
     std_buf = kwargs.get("stdio_buffer", None)
 
     if len(path) == 0:
         return
 
+    if output_format != "dot":
+        print_record(std_buf, output_format,
+                     path_record(path, reverse, externs=externs,
+                                 truncated=truncated))
+        return
+
     ascii_path = ""
     for function in reversed(path) if reverse else path:
         if ascii_path != "":
@@ -378,6 +1182,91 @@ def dump_path_ascii(path, reverse, **kwargs):
     print_buf(std_buf, ascii_path + ";")
 
 
+#
+# Walk all paths starting at function_name, and yield them as they are found.
+# This is the same traversal as dump_path(), which is kept separate as the
+# generator is slower for the default .dot output.
+# Each entry is a ("path", path, externs, truncated) tuple, or a
+# ("node", [function], False, True) tuple for a function that had calls
+# removed. The path is in traversal order, so for a callee walk it needs to
+# be reversed to get the call order.
+#
+def walk_path(path, functions, function_name, **kwargs):
+
+    max_depth = kwargs.get("max_depth", 0)
+    exclude = kwargs.get("exclude", None)
+    call_index = kwargs.get("call_index", "calls")
+    no_externs = kwargs.get("no_externs", False)
+
+    #
+    # Pass on __seen_in_path as a way to determine if a node in the graph
+    # was already processed
+    #
+    if "__seen_in_path" in kwargs:
+        seen_in_path = kwargs["__seen_in_path"]
+    else:
+        seen_in_path = dict()
+        kwargs["__seen_in_path"] = seen_in_path
+
+    #
+    # If reached the max depth or need to stop due to exclusion, recursion
+    # display the path up till the previous entry.
+    #
+    if (exclude is not None and re.match(exclude, function_name) is not None) \
+       or (max_depth > 0 and len(path) >= max_depth):
+        if len(path) > 0:
+            yield "path", path, False, True
+        return
+
+    #
+    # If already seen, we need to terminate the path here...
+    #
+    if function_name in seen_in_path:
+        if (max_depth <= 0 or (len(path) + 1) <= max_depth):
+            yield "path", path + [function_name], False, False
+        return
+
+    seen_in_path[function_name] = True
+
+    #
+    # Now walk the path for each child
+    #
+    children = 0
+    for caller in functions[function_name][call_index]:
+        #
+        # The child is a known function, handle this trough recursion
+        #
+        if caller in functions:
+            children += 1
+            if function_name != caller:
+                yield from walk_path(path + [function_name],
+                                     functions, caller, **kwargs)
+            else:
+                #
+                # This is a recurrence for this function, add it once
+                #
+                yield "path", path + [function_name, caller], False, False
+
+        #
+        # This is a external child, so we can not handle this recursive.
+        # However as there are no more children, we can handle it here
+        # (if it can be included).
+        #
+        elif (exclude is None or re.match(exclude, caller) is None) and \
+             (max_depth <= 0 or (len(path) + 2) <= max_depth) and \
+                not no_externs:
+            children += 1
+            yield "path", path + [function_name, caller], True, False
+        else:
+            yield "node", [function_name], False, True
+
+    #
+    # If there where no children, the path ends here, so dump it.
+    #
+    if children == 0:
+        yield "path", path + [function_name], False, False
+
+
 #
 # Dump path as ASCII to stdout
 #
@@ -388,6 +1277,7 @@ def dump_path(path, functions, function_name, **kwargs):
     exclude = kwargs.get("exclude", None)
     call_index = kwargs.get("call_index", "calls")
     no_externs = kwargs.get("no_externs", False)
+    output_format = kwargs.get("output_format", "dot")
     std_buf = kwargs.get("stdio_buffer", None)
 
     #
@@ -407,7 +1297,7 @@ def dump_path(path, functions, function_name, **kwargs):
     if (exclude is not None and re.match(exclude, function_name) is not None) \
        or (max_depth > 0 and len(path) >= max_depth):
         dump_path_ascii(path, reverse_path, stdio_buffer=std_buf,
-                        truncated=True)
+                        truncated=True, output_format=output_format)
         return
 
     #
@@ -416,7 +1306,8 @@ def dump_path(path, functions, function_name, **kwargs):
     if function_name in seen_in_path:
         if (max_depth <= 0 or (len(path) + 1) <= max_depth):
             dump_path_ascii(path + [function_name], reverse_path,
-                            stdio_buffer=std_buf)
+                            stdio_buffer=std_buf,
+                            output_format=output_format)
         return
 
     seen_in_path[function_name] = True
@@ -439,7 +1330,8 @@ def dump_path(path, functions, function_name, **kwargs):
                 # This is a recurrence for this function, add it once
                 #
                 dump_path_ascii(path + [function_name, caller], reverse_path,
-                                stdio_buffer=std_buf)
+                                stdio_buffer=std_buf,
+                                output_format=output_format)
 
         #
         # This is a external child, so we can not handle this recursive.
@@ -451,17 +1343,215 @@ def dump_path(path, functions, function_name, **kwargs):
                 not no_externs:
             children += 1
             dump_path_ascii(path + [function_name, caller], reverse_path,
-                            externs=True, stdio_buffer=std_buf)
+                            externs=True, stdio_buffer=std_buf,
+                            output_format=output_format)
         else:
-            print_buf(std_buf, '"{}" [color=red];'.
-                      format(function_name))
+            print_node(std_buf, output_format, function_name, truncated=True)
 
     #
     # If there where no children, the path ends here, so dump it.
     #
     if children == 0:
         dump_path_ascii(path + [function_name], reverse_path,
-                        stdio_buffer=std_buf)
+                        stdio_buffer=std_buf, output_format=output_format)
+
+
+#
+# State shared with the parallel dump_path() workers. It's set right before
+# the worker pool is forked, so the workers share the function database
+# copy-on-write, and only the roots and the location of their output are
+# passed around.
+#
+parallel_functions = None
+parallel_kwargs = None
+parallel_headroom = 0
+parallel_spool_dir = None
+
+#
+# Per worker spool file, holding the output of all roots it processed, and
+# whether the recursion limit was adjusted.
+#
+parallel_spool = None
+parallel_spool_file = None
+parallel_recursion_limit_set = False
+
+#
+# Size of the chunks used to copy the spooled output, and the number of
+# extra nested calls allowed for writing to the spool file. The spool flushes
+# at other moments than stdout does, which can add a few calls at the deepest
+# point of the traversal.
+#
+parallel_chunk_size = 65536
+parallel_write_calls = 8
+
+
+#
+# recursion_headroom()
+#
+# Number of nested calls the caller can still make before it runs into the
+# recursion limit.
+#
+def recursion_headroom():
+    def probe(depth):
+        try:
+            return probe(depth + 1)
+        except RecursionError:
+            return depth
+
+    return probe(0)
+
+
+#
+# parallel_dump_path_init()
+#
+def parallel_dump_path_init():
+    global parallel_spool
+    global parallel_spool_file
+
+    spool_fd, parallel_spool_file = tempfile.mkstemp(dir=parallel_spool_dir)
+    parallel_spool = io.open(spool_fd, "w", encoding="utf-8",
+                             errors="surrogateescape")
+
+
+#
+# parallel_dump_path_worker()
+#
+# The worker is forked while the parent is in dump_paths(), however, it
+# starts with more calls on its stack than dump_paths() had in the parent.
+# So on the first task the recursion limit is raised by that amount, plus
+# parallel_write_calls, to allow at least the same traversal depth as a
+# serial run. An exception is returned
+# with the output written up till then, so the parent can raise it in the
+# right place.
+#
+def parallel_dump_path_worker(task):
+    global parallel_recursion_limit_set
+
+    index, root = task
+    if not parallel_recursion_limit_set:
+        sys.setrecursionlimit(sys.getrecursionlimit() +
+                              parallel_write_calls +
+                              max(0, parallel_headroom -
+                                  recursion_headroom()))
+        parallel_recursion_limit_set = True
+
+    parallel_spool.flush()
+    offset = parallel_spool.buffer.tell()
+
+    error = None
+    stdout = sys.stdout
+    sys.stdout = parallel_spool
+    try:
+        dump_path([], parallel_functions, root, **parallel_kwargs)
+    except Exception as e:
+        error = e
+    finally:
+        sys.stdout = stdout
+
+    parallel_spool.flush()
+    return (index, parallel_spool_file, offset,
+            parallel_spool.buffer.tell() - offset, error)
+
+
+#
+# Run dump_path() for all roots in a pool of jobs worker processes, and yield
+# an (index, spool file, offset, length, error) tuple for each root as soon
+# as it's done, i.e. not in the order of the roots. The spool files are
+# removed once all results are yielded. Headroom is the recursion_headroom()
+# of the function that would call dump_path() in a serial run.
+#
+def parallel_dump_path_results(functions, roots, jobs, headroom, **kwargs):
+    global parallel_functions
+    global parallel_kwargs
+    global parallel_headroom
+    global parallel_spool_dir
+
+    parallel_functions = functions
+    parallel_kwargs = kwargs
+    parallel_headroom = headroom
+    parallel_spool_dir = tempfile.mkdtemp(prefix="cally-")
+    try:
+        sys.stdout.flush()
+        pool = multiprocessing.get_context("fork").Pool(
+            jobs, parallel_dump_path_init)
+        try:
+            for result in pool.imap_unordered(
+                    parallel_dump_path_worker, enumerate(roots),
+                    max(1, len(roots) // (jobs * 4))):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        parallel_functions = None
+        parallel_kwargs = None
+        shutil.rmtree(parallel_spool_dir, ignore_errors=True)
+        parallel_spool_dir = None
+
+
+#
+# parallel_copy_output()
+#
+def parallel_copy_output(spools, spool_file, offset, length):
+    if spool_file not in spools:
+        spools[spool_file] = open(spool_file, "rb")
+
+    spool = spools[spool_file]
+    spool.seek(offset)
+    decoder = codecs.getincrementaldecoder("utf-8")("surrogateescape")
+    while length > 0:
+        data = spool.read(min(length, parallel_chunk_size))
+        if len(data) == 0:
+            break
+        length -= len(data)
+        sys.stdout.write(decoder.decode(data, length <= 0))
+
+
+#
+# Dump the paths for all root functions, optionally using multiple worker
+# processes. The workers write their output to spool files, which are copied
+# to stdout in the order of the given roots, so it's identical to a serial
+# run. The stdio_buffer option is only supported for a single job.
+#
+def dump_paths(functions, roots, **kwargs):
+    jobs = kwargs.pop("jobs", 1)
+    output_format = kwargs.get("output_format", "dot")
+    std_buf = kwargs.get("stdio_buffer", None)
+
+    if jobs != 1 and std_buf is not None:
+        raise ValueError("stdio_buffer can not be used with multiple jobs")
+
+    if jobs <= 0:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(roots))
+
+    if jobs <= 1 or \
+       "fork" not in multiprocessing.get_all_start_methods():
+        for root in roots:
+            print_root(std_buf, output_format, root)
+            dump_path([], functions, root, **kwargs)
+        return
+
+    pending = dict()
+    next_index = 0
+    spools = dict()
+    results = parallel_dump_path_results(functions, roots, jobs,
+                                         recursion_headroom(), **kwargs)
+    try:
+        for result in results:
+            pending[result[0]] = result
+            while next_index in pending:
+                index, spool_file, offset, length, error = \
+                    pending.pop(next_index)
+                print_root(None, output_format, roots[index])
+                parallel_copy_output(spools, spool_file, offset, length)
+                if error is not None:
+                    raise error
+                next_index += 1
+    finally:
+        for spool in spools.values():
+            spool.close()
+        results.close()
 
 
 #
@@ -487,6 +1577,68 @@ def print_buf(buf, text):
     print(text)
 
 
+#
+# print_record()
+#
+# Print a single record for the json and ndjson output formats. The json
+# format is one array, which is opened by the graph record printed by
+# print_graph_begin(), so all following records are prefixed by a comma. This
+# way records are streamed as they are generated for both formats.
+#
+def print_record(buf, output_format, record):
+    print_buf(buf, ("," if output_format == "json" else "") +
+              json.dumps(record))
+
+
+#
+# print_graph_begin()
+#
+def print_graph_begin(buf, output_format, query):
+    if output_format == "dot":
+        print_buf(buf, "strict digraph callgraph {")
+    else:
+        print_buf(buf, ("[" if output_format == "json" else "") +
+                  json.dumps({"type": "graph", "query": query}))
+
+
+#
+# print_graph_end()
+#
+def print_graph_end(buf, output_format):
+    if output_format == "dot":
+        print_buf(buf, "}")
+    elif output_format == "json":
+        print_buf(buf, "]")
+
+
+#
+# print_root()
+#
+def print_root(buf, output_format, function):
+    if output_format == "dot":
+        print_buf(buf, '"{}" [color=blue, style=filled];'.format(function))
+    else:
+        print_record(buf, output_format, {"type": "root", "name": function})
+
+
+#
+# print_node()
+#
+def print_node(buf, output_format, function, **kwargs):
+    externs = kwargs.get("externs", False)
+    truncated = kwargs.get("truncated", False)
+
+    if output_format == "dot":
+        print_buf(buf, '"{}"{}{}'.format(
+            function,
+            " [style=dashed]" if externs else "",
+            " [color=red];" if truncated else ""))
+    else:
+        print_record(buf, output_format,
+                     node_record(function, externs=externs,
+                                 truncated=truncated))
+
+
 #
 # Dump function details:
 #
@@ -513,9 +1665,10 @@ def dump_function_info(functions, function, details):
 def full_call_graph(functions, **kwargs):
     exclude = kwargs.get("exclude", None)
     no_externs = kwargs.get("no_externs", False)
+    output_format = kwargs.get("output_format", "dot")
     std_buf = kwargs.get("stdio_buffer", None)
 
-    print_buf(std_buf, "strict digraph callgraph {")
+    print_graph_begin(std_buf, output_format, "full")
     #
     # Simply walk all nodes and print the callers
     #
@@ -529,29 +1682,291 @@ def full_call_graph(functions, **kwargs):
                    (exclude is None or
                    re.match(exclude, caller) is None):
 
-                    print_buf(std_buf, '"{}" -> "{}";'.format(func, caller))
-
-                    if caller not in functions:
-                        print_buf(std_buf, '"{}" [style=dashed]'.
-                                  format(caller))
+                    if output_format == "dot":
+                        print_buf(std_buf, '"{}" -> "{}";'.
+                                  format(func, caller))
+
+                        if caller not in functions:
+                            print_node(std_buf, output_format, caller,
+                                       externs=True)
+                    else:
+                        print_record(std_buf, output_format,
+                                     {"type": "edge",
+                                      "caller": func,
+                                      "callee": caller,
+                                      "external": caller not in functions,
+                                      "recursive": func == caller})
 
                     printed_functions += 1
 
             if printed_functions == 0:
-                print_buf(std_buf, '"{}"'.format(func))
+                print_node(std_buf, output_format, func)
 
-    print_buf(std_buf, "}")
+    print_graph_end(std_buf, output_format)
 
 
 #
-# Main()
+# CallGraph, the function database and the queries on it. This can be used
+# to embed cally in other tools, for example:
 #
-def main():
+#   graph = CallGraph.from_rtl_files(["main.c.229r.expand"])
+#   for path in graph.paths("main", max_depth=3):
+#       ...
+#
+# All query methods are generators, so results can be consumed as they are
+# found. The reverse, callee, indexes are only built on first use.
+#
+class CallGraph(object):
+
     #
-    # Data sets
+    # Regex to extract functions
     #
-    functions = dict()
+    function_regex = re.compile(
+        r"^;; Function (?P<mangle>.*)\s+\((?P<function>\S+)(,.*)?\).*$")
+    call_regex = re.compile(
+        r"^.*\(call.*\"(?P<target>.*)\".*$")
+    symbol_ref_regex = re.compile(r"^.*\(symbol_ref.*\"(?P<target>.*)\".*$")
+
+    cache_version = 1
+
+    def __init__(self, functions=None):
+        self.functions = functions if functions is not None else dict()
+        self.callee_info = False
+
+    def __contains__(self, function):
+        return function in self.functions
+
+    def __len__(self):
+        return len(self.functions)
+
+    #
+    # Build a graph from a list of RTL files
+    #
+    @classmethod
+    def from_rtl_files(cls, files, **kwargs):
+        graph = cls()
+        for file in files:
+            with open(file) as rtl_file:
+                graph.add_rtl_lines(rtl_file, file, **kwargs)
+        return graph
+
+    #
+    # Build a graph from an iterator of RTL lines
+    #
+    @classmethod
+    def from_lines(cls, lines, filename="<lines>", **kwargs):
+        graph = cls()
+        graph.add_rtl_lines(lines, filename, **kwargs)
+        return graph
+
+    #
+    # Build a graph from a cache file written by save_cache()
+    #
+    @classmethod
+    def from_cache(cls, file):
+        with open(file) as cache_file:
+            cache = json.load(cache_file)
+
+        if cache.get("version") != cls.cache_version:
+            raise ValueError("Unsupported cache version in \"{}\"".
+                             format(file))
+
+        graph = cls()
+        for function_name, finfo in cache["functions"].items():
+            graph.add_function(function_name)
+            graph.functions[function_name]["files"] = finfo["files"]
+            for target in finfo["calls"]:
+                graph.functions[function_name]["calls"][target] = True
+            for target in finfo["refs"]:
+                graph.functions[function_name]["refs"][target] = True
+        return graph
+
+    #
+    # Save the graph to a cache file, the callee info is not stored as it's
+    # rebuild when needed.
+    #
+    def save_cache(self, file):
+        cache = {"version": self.cache_version,
+                 "functions": dict()}
+        for function_name, finfo in self.functions.items():
+            cache["functions"][function_name] = {
+                "files": finfo["files"],
+                "calls": list(finfo["calls"]),
+                "refs": list(finfo["refs"])}
+
+        with open(file, "w") as cache_file:
+            json.dump(cache, cache_file)
+
+    #
+    # Add a new, empty, function to the database
+    #
+    def add_function(self, function_name):
+        self.functions[function_name] = dict()
+        self.functions[function_name]["files"] = list()
+        self.functions[function_name]["calls"] = dict()
+        self.functions[function_name]["refs"] = dict()
+        self.functions[function_name]["callee_calls"] = dict()
+        self.functions[function_name]["callee_refs"] = dict()
+
+    #
+    # Parse each RTL line given. If the symbol references are not needed,
+    # symbol_refs=False skips extracting them, leaving the refs and
+    # callee_refs indexes empty.
+    #
+    # Each call starts outside of a function, so lines of a file before its
+    # first function are ignored, rather than being added to the last
+    # function of the previous file.
+    #
+    def add_rtl_lines(self, lines, filename, **kwargs):
+        no_warnings = kwargs.get("no_warnings", False)
+        symbol_refs = kwargs.get("symbol_refs", True)
+        functions = self.functions
+        self.callee_info = False
+
+        function_name = None
+        for line in lines:
+            #
+            # Find function entry point
+            #
+            match = re.match(self.function_regex, line)
+            if match is not None:
+                function_name = match.group("function")
+                if function_name in functions:
+                    if not no_warnings:
+                        print_err("WARNING: Function {} defined in multiple"
+                                  "files \"{}\"!".
+                                  format(function_name,
+                                         ', '.join(map(
+                                             str,
+                                             functions[function_name]
+                                             ["files"] + [filename]))))
+                else:
+                    self.add_function(function_name)
+
+                functions[function_name]["files"].append(filename)
+            #
+            # Lines outside of a function can not hold any calls
+            #
+            elif function_name is None:
+                continue
+            #
+            #
+            # Find direct function calls
+            else:
+                match = re.match(self.call_regex, line)
+                if match is not None:
+                    target = match.group("target")
+                    if target not in functions[function_name]["calls"]:
+                        functions[function_name]["calls"][target] = True
+                elif symbol_refs:
+                    match = re.match(self.symbol_ref_regex, line)
+                    if match is not None:
+                        target = match.group("target")
+                        if target not in functions[function_name]["refs"]:
+                            functions[function_name]["refs"][target] = True
+
+    #
+    # Build the reverse, callee, indexes, if not already done. Any old
+    # entries are removed first, so the order is the same as for a graph that
+    # was build in one go.
+    #
+    def build_callee_info(self):
+        if self.callee_info:
+            return
+
+        for finfo in self.functions.values():
+            finfo["callee_calls"].clear()
+            finfo["callee_refs"].clear()
+
+        build_callee_info(self.functions)
+        self.callee_info = True
+
+    #
+    # Functions called by function, including external functions
+    #
+    def callees(self, function):
+        for callee in self.functions[function]["calls"]:
+            yield callee
+
+    #
+    # Functions calling function
+    #
+    def callers(self, function):
+        self.build_callee_info()
+        for caller in self.functions[function]["callee_calls"]:
+            yield caller
+
+    #
+    # All paths starting at function, as records in the same format as the
+    # json output. With reverse=True the paths leading to function are
+    # returned, i.e. a callee graph. Supported keyword arguments are
+    # max_depth, exclude and no_externs.
+    #
+    def paths(self, function, **kwargs):
+        reverse = kwargs.pop("reverse", False)
+        if reverse:
+            self.build_callee_info()
+            kwargs["call_index"] = "callee_calls"
+
+        for kind, nodes, externs, truncated in \
+                walk_path([], self.functions, function, **kwargs):
+            if kind == "node":
+                yield node_record(nodes[-1], truncated=truncated)
+            else:
+                yield path_record(nodes, reverse, externs=externs,
+                                  truncated=truncated)
+
+    #
+    # All functions reachable from function, in breadth first order. With
+    # reverse=True the functions that can reach function are returned.
+    # External functions are only returned for forward walks.
+    #
+    def reachable(self, function, reverse=False):
+        call_index = "callee_calls" if reverse else "calls"
+        if reverse:
+            self.build_callee_info()
+
+        seen = set()
+        queue = collections.deque([function])
+        while queue:
+            for child in self.functions[queue.popleft()][call_index]:
+                if child in seen:
+                    continue
+                seen.add(child)
+                yield child
+                if child in self.functions:
+                    queue.append(child)
 
+    #
+    # All (caller, callee) call edges, sorted the same way as the full call
+    # graph output.
+    #
+    def edges(self):
+        for function in sorted(self.functions.keys()):
+            for callee in sorted(self.functions[function]["calls"].keys()):
+                yield function, callee
+
+    #
+    # Output helpers used by the command line interface
+    #
+    def dump_function_info(self, function, details):
+        if details:
+            self.build_callee_info()
+        dump_function_info(self.functions, function, details)
+
+    def full_call_graph(self, **kwargs):
+        full_call_graph(self.functions, **kwargs)
+
+    def dump_paths(self, roots, **kwargs):
+        if kwargs.get("call_index", "calls") == "callee_calls":
+            self.build_callee_info()
+        dump_paths(self.functions, roots, **kwargs)
+
+
+#
+# Main()
+#
+def main():
     #
     # Command line argument parsing
     #
@@ -581,8 +1996,19 @@ def main():
     parser.add_argument("--max-depth", metavar="DEPTH",
                         help="Maximum tree depth traversal, default no depth",
                         type=int, default=0)
+    parser.add_argument("-j", "--jobs", metavar="JOBS",
+                        help="Number of parallel processes used for --caller "
+                        "or --callee traversal, 0 uses all CPUs, default 1",
+                        type=int, default=1)
+    parser.add_argument("--format", metavar="FORMAT",
+                        help="Call graph output format, dot, json or "
+                        "ndjson, default dot",
+                        type=str, default="dot",
+                        choices=["dot", "json", "ndjson"])
     parser.add_argument("--unit-test", help=argparse.SUPPRESS,
                         action="store_true")
+    parser.add_argument("--random-test", help=argparse.SUPPRESS,
+                        type=int, metavar="SEED")
 
     parser.add_argument("RTLFILE", help="GCCs RTL .expand file", nargs="+")
 
@@ -595,6 +2021,9 @@ def main():
     if config.unit_test:
         return unit_test()
 
+    if config.random_test is not None:
+        return random_test(config.random_test)
+
     #
     # Additional option checks
     #
@@ -628,74 +2057,33 @@ def main():
             return 1
 
     #
-    # Regex to extract functions
+    # Parse all RTL files given. None of the queries below use the symbol
+    # references, so skip extracting them.
     #
-    function = re.compile(
-        r"^;; Function (?P<mangle>.*)\s+\((?P<function>\S+)(,.*)?\).*$")
-    call = re.compile(
-        r"^.*\(call.*\"(?P<target>.*)\".*$")
-    symbol_ref = re.compile(r"^.*\(symbol_ref.*\"(?P<target>.*)\".*$")
-
-    #
-    # Parse each line in each file given
-    #
-    function_name = ""
     start_time = time.time()
-    for line in fileinput.input(config.RTLFILE):
-        #
-        # Find function entry point
-        #
-        match = re.match(function, line)
-        if match is not None:
-            function_name = match.group("function")
-            if function_name in functions:
-                if not config.no_warnings:
-                    print_err("WARNING: Function {} defined in multiple"
-                              "files \"{}\"!".
-                              format(function_name,
-                                     ', '.join(map(
-                                         str,
-                                         functions[function_name]["files"] +
-                                         [fileinput.filename()]))))
-            else:
-                functions[function_name] = dict()
-                functions[function_name]["files"] = list()
-                functions[function_name]["calls"] = dict()
-                functions[function_name]["refs"] = dict()
-                functions[function_name]["callee_calls"] = dict()
-                functions[function_name]["callee_refs"] = dict()
-
-            functions[function_name]["files"].append(fileinput.filename())
-        #
-        #
-        # Find direct function calls
-        else:
-            match = re.match(call, line)
-            if match is not None:
-                target = match.group("target")
-                if target not in functions[function_name]["calls"]:
-                    functions[function_name]["calls"][target] = True
-            else:
-                match = re.match(symbol_ref, line)
-                if match is not None:
-                    target = match.group("target")
-                    if target not in functions[function_name]["refs"]:
-                        functions[function_name]["refs"][target] = True
+    graph = CallGraph()
+    for file in config.RTLFILE:
+        with open(file) as rtl_file:
+            graph.add_rtl_lines(rtl_file, file,
+                                no_warnings=config.no_warnings,
+                                symbol_refs=False)
 
     if config.debug:
         print_dbg("[PERF] Processing {} RTL files took {:.9f} seconds".format(
             len(config.RTLFILE), time.time() - start_time))
-        print_dbg("[PERF] Found {} functions".format(len(functions)))
+        print_dbg("[PERF] Found {} functions".format(len(graph)))
     #
-    # Build callee data
+    # Build callee data, only the callee graph and the detailed function
+    # dump need it.
     #
-    start_time = time.time()
+    if config.callee or (config.functions != "&None" and config.debug):
+        start_time = time.time()
 
-    build_callee_info(functions)
+        graph.build_callee_info()
 
-    if config.debug:
-        print_dbg("[PERF] Building callee info took {:.9f} seconds".format(
-            time.time() - start_time))
+        if config.debug:
+            print_dbg("[PERF] Building callee info took {:.9f} seconds".
+                      format(time.time() - start_time))
 
     #
     # Dump functions if requested
@@ -704,11 +2092,11 @@ def main():
         print("\nFunction dump")
         print("-------------")
         if config.functions == "&all":
-            for func in sorted(functions.keys()):
-                dump_function_info(functions, func, config.debug)
+            for func in sorted(graph.functions.keys()):
+                graph.dump_function_info(func, config.debug)
         else:
-            if config.functions in functions:
-                dump_function_info(functions, config.functions, config.debug)
+            if config.functions in graph:
+                graph.dump_function_info(config.functions, config.debug)
             else:
                 print_err("ERROR: Can't find callee, \"{}\" in RTL data!".
                           format(config.callee))
@@ -720,45 +2108,46 @@ def main():
     # Dump full call graph
     #
     if not config.caller and not config.callee:
-        full_call_graph(functions, exclude=config.exclude,
-                        no_externs=config.no_externs)
+        graph.full_call_graph(exclude=config.exclude,
+                              no_externs=config.no_externs,
+                              output_format=config.format)
 
     #
     # Build callgraph for callee function
     #
     if config.callee and len(config.callee) != 0:
         for callee in config.callee:
-            if callee not in functions:
+            if callee not in graph:
                 print_err("ERROR: Can't find callee \"{}\" in RTL data!".
                           format(callee))
                 return 1
-        print("strict digraph callgraph {")
-        for callee in config.callee:
-            print('"{}" [color=blue, style=filled];'.format(callee))
-            dump_path([], functions, callee,
-                      max_depth=config.max_depth,
-                      reverse_path=True,
-                      exclude=exclude_regex,
-                      call_index="callee_calls")
-        print("}")
+        print_graph_begin(None, config.format, "callee")
+        graph.dump_paths(config.callee,
+                         jobs=config.jobs,
+                         max_depth=config.max_depth,
+                         reverse_path=True,
+                         exclude=exclude_regex,
+                         call_index="callee_calls",
+                         output_format=config.format)
+        print_graph_end(None, config.format)
 
     #
     # Build callgraph for caller function
     #
     elif config.caller and len(config.caller) != 0:
         for caller in config.caller:
-            if caller not in functions:
+            if caller not in graph:
                 print_err("ERROR: Can't find caller \"{}\" in RTL data!".
                           format(caller))
                 return 1
-        print("strict digraph callgraph {")
-        for caller in config.caller:
-            print('"{}" [color=blue, style=filled];'.format(caller))
-            dump_path([], functions, caller,
-                      max_depth=config.max_depth,
-                      exclude=exclude_regex,
-                      no_externs=config.no_externs)
-        print("}")
+        print_graph_begin(None, config.format, "caller")
+        graph.dump_paths(config.caller,
+                         jobs=config.jobs,
+                         max_depth=config.max_depth,
+                         exclude=exclude_regex,
+                         no_externs=config.no_externs,
+                         output_format=config.format)
+        print_graph_end(None, config.format)
 
     if config.debug:
         print_dbg("[PERF] Generating .dot file took {:.9f} seconds".format(